@@ -0,0 +1,65 @@
+'''One-time migration of the gzipped JSON snapshots in DATA_DIR into an hourly partitioned Parquet dataset'''
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+import pyarrow as pa
+import pyarrow.parquet as pq
+from tqdm import tqdm
+from process import DATA_DIR, PARQUET_DIR, PARQUET_SCHEMA, load_snapshot
+
+
+NS_PER_HOUR = 3600 * 1_000_000_000
+
+
+def to_table(t_ns: int, aircraft_list: list) -> pa.Table:
+    alt_baro = [aircraft.get('alt_baro') for aircraft in aircraft_list]
+    return pa.table({
+        'hex': [aircraft['hex'] for aircraft in aircraft_list],
+        't_ns': [t_ns] * len(aircraft_list),
+        'lat': [aircraft.get('lat') for aircraft in aircraft_list],
+        'lon': [aircraft.get('lon') for aircraft in aircraft_list],
+        'alt_baro': [None if alt == 'ground' else alt for alt in alt_baro],
+        'alt_geom': [aircraft.get('alt_geom') for aircraft in aircraft_list],
+        'ground': [alt == 'ground' for alt in alt_baro],
+        'type': [aircraft['type'] for aircraft in aircraft_list],
+        'flight': [aircraft.get('flight') for aircraft in aircraft_list],
+        'r': [aircraft.get('r') for aircraft in aircraft_list],
+        't': [aircraft.get('t') for aircraft in aircraft_list],
+        'dbFlags': [aircraft.get('dbFlags', 0) for aircraft in aircraft_list],
+        'seen': [aircraft.get('seen') for aircraft in aircraft_list],
+        'lastPosition': ['lastPosition' in aircraft for aircraft in aircraft_list],
+    }, schema=PARQUET_SCHEMA)
+
+
+def main() -> None:
+    # Build the dataset next to its final location and only move it into place once complete,
+    # so an interrupted run never leaves a partial dataset at PARQUET_DIR
+    partial_dir = f'{PARQUET_DIR}.partial'
+    shutil.rmtree(partial_dir, ignore_errors=True)
+    files = sorted(os.listdir(DATA_DIR))
+    writers: dict[int, pq.ParquetWriter] = {}
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for t_ns, aircraft_list in tqdm(executor.map(load_snapshot, files, chunksize=8), total=len(files)):
+            hour = t_ns // NS_PER_HOUR % 24
+            writer = writers.get(hour)
+            if not writer:
+                os.makedirs(f'{partial_dir}/hour={hour:02d}', exist_ok=True)
+                writer = pq.ParquetWriter(f'{partial_dir}/hour={hour:02d}/part-0.parquet', PARQUET_SCHEMA)
+                writers[hour] = writer
+            writer.write_table(to_table(t_ns, aircraft_list))
+    for writer in writers.values():
+        writer.close()
+    if not writers:
+        raise FileNotFoundError(f'No snapshots in {DATA_DIR}, leaving {PARQUET_DIR} untouched')
+
+    # Move any previous dataset aside rather than deleting it, it is only removed once the new one is in place
+    old_dir = f'{PARQUET_DIR}.old'
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.isdir(PARQUET_DIR):
+        os.replace(PARQUET_DIR, old_dir)
+    os.replace(partial_dir, PARQUET_DIR)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
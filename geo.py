@@ -0,0 +1,26 @@
+'''Compiled great circle kernels, kept out of process.py so that module can be built with mypyc'''
+import math
+import numba
+
+MEAN_EARTH_RADIUS_METERS = 6371008.7714  # https://en.wikipedia.org/wiki/Earth_radius#Published_values
+RADIANS_PER_DEGREE = math.pi / 180.0
+
+
+@numba.njit(cache=True, fastmath=True)
+def great_circle_point(lat1: float, long1: float, lat2: float, long2: float) -> float:
+    '''Great circle distance in meters between two points given in degrees'''
+    # Differences are taken in degrees so each one needs a single scaling into half-angle radians
+    sin_half_lat = math.sin((lat2 - lat1) * (0.5 * RADIANS_PER_DEGREE))
+    sin_half_long = math.sin((long2 - long1) * (0.5 * RADIANS_PER_DEGREE))
+    cos_lat1 = math.cos(lat1 * RADIANS_PER_DEGREE)
+    cos_lat2 = math.cos(lat2 * RADIANS_PER_DEGREE)
+
+    # Haversine form, well conditioned for the short hops typical of a dropout
+    a = sin_half_lat * sin_half_lat + cos_lat1 * cos_lat2 * sin_half_long * sin_half_long
+    return 2.0 * MEAN_EARTH_RADIUS_METERS * math.asin(math.sqrt(min(a, 1.0)))
+
+
+@numba.vectorize([numba.float64(numba.float64, numba.float64, numba.float64, numba.float64)], cache=True, fastmath=True)
+def great_circle(lat1, long1, lat2, long2):
+    '''Element-wise great circle distance in meters between two sets of points given in degrees'''
+    return great_circle_point(lat1, long1, lat2, long2)
@@ -1,24 +1,57 @@
+import dataclasses
 import datetime
 import enum
-import gzip
-import json
 import logging
-import math
 import os
-from multiprocessing import Process, Queue
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from isal import igzip
+import numpy as np
+import orjson
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset
+import pyarrow.parquet as pq
 from tqdm import tqdm
+from geo import great_circle
 
 DATA_DIR = './data/samples.adsbexchange.com/readsb-hist/2022/03/01'
+DATA_DATE_NS = int(datetime.datetime(2022, 3, 1, tzinfo=datetime.timezone.utc).timestamp()) * 1_000_000_000  # Midnight of the day in DATA_DIR
+PARQUET_DIR = './data/parquet/2022/03/01'  # Written from DATA_DIR by convert.py, read instead of it when present
 MILITARY = 0b0001  # military aircraft
 INTERESTING = 0b0010  # ???
 PIA = 0b0100  # Privacy ICAO aircraft address
 LADD = 0b1000  # Limiting Aircraft Data Displayed
 LAST_POS_THRESHOLD = 60.0
-LAST_POS_DELTA = datetime.timedelta(seconds=LAST_POS_THRESHOLD)  # Consider coverage lost if we haven't gotten a position in this period
-MEAN_EARTH_RADIUS_METERS = 6371008.7714  # https://en.wikipedia.org/wiki/Earth_radius#Published_values
-MAX_QUEUE_SIZE = 50
+LAST_POS_DELTA_NS = int(LAST_POS_THRESHOLD * 1_000_000_000)  # Consider coverage lost if we haven't gotten a position in this period
+
+# Fields of a readsb aircraft record that the model reads, everything else is dropped at load time
+UPDATE_FIELDS = ('hex', 'type', 'flight', 'r', 't', 'dbFlags', 'lat', 'lon', 'alt_baro', 'alt_geom')
+SNAPSHOT_FIELDS = UPDATE_FIELDS + ('seen',)  # load_snapshot keeps staleness too, for convert.py
+
+# Columnar layout of the Parquet dataset, one row per aircraft per snapshot
+PARQUET_SCHEMA = pa.schema([
+    ('hex', pa.string()),
+    ('t_ns', pa.int64()),  # Snapshot time, ns since the epoch
+    ('lat', pa.float64()),
+    ('lon', pa.float64()),
+    ('alt_baro', pa.int32()),  # Null when on the ground, see 'ground'
+    ('alt_geom', pa.int32()),
+    ('ground', pa.bool_()),
+    ('type', pa.dictionary(pa.int8(), pa.string())),
+    ('flight', pa.string()),
+    ('r', pa.string()),
+    ('t', pa.string()),
+    ('dbFlags', pa.uint8()),
+    ('seen', pa.float32()),
+    ('lastPosition', pa.bool_()),
+])
+UPDATE_COLUMNS = tuple(name for name in PARQUET_SCHEMA.names if name not in ('t_ns', 'ground', 'seen', 'lastPosition'))  # Copied into each record
 
 logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(levelname)s %(message)s')
+logger = logging.getLogger(__name__)
 
 
 class MessageType(enum.Enum):
@@ -36,96 +69,98 @@ class MessageType(enum.Enum):
     TISB_TRACKFILE = "tisb_trackfile"
 
 
-class Position(object):
+_MSG_BY_VALUE: dict[str | MessageType, MessageType] = {m.value: m for m in MessageType}
+_MSG_BY_VALUE.update({m: m for m in MessageType})  # Already coerced members map to themselves
+
+
+@dataclasses.dataclass(slots=True)
+class Position:
     '''Representation of a particular update'''
-    def __init__(self, update: dict, update_time: datetime.datetime) -> None:
-        self.time = update_time
-        self.lat = update['lat']
-        self.long = update['lon']
-        self.alt = update.get('alt_baro', update.get('alt_geom'))
-        self.type = MessageType(update['type'])
+    time: int  # ns since the epoch
+    lat: float
+    long: float
+    alt: int | float | str | None  # Barometric altitude in feet, or 'ground'
+    type: MessageType | str  # Raw readsb value is coerced to MessageType
+    alt_geom: dataclasses.InitVar[int | float | None] = None
+
+    def __post_init__(self, alt_geom: int | float | None) -> None:
+        if self.alt is None:
+            self.alt = alt_geom
+        self.type = _MSG_BY_VALUE.get(self.type, MessageType.OTHER)
     
     def __str__(self) -> str:
         return f"Latitude: {self.lat}, Longitude: {self.long}, Altitude: {self.alt}{'' if self.alt == 'ground' else 'ft'}"
 
 
-class Dropout(object):
-    '''Representation of a presumed coverage dropout of a particular flight'''
-    def __init__(self, hex: str, start: Position, end: Position) -> None:
-        self.hex = hex
-        self.start = start
-        self.end = end
+@dataclasses.dataclass(slots=True)
+class Dropout:
+    '''Representation of a presumed coverage dropout of a particular flight, its distance is in World.distances'''
+    hex: str
+    start: Position
+    end: Position
     
     def asdict(self) -> dict:
         return {"lat1": self.start.lat, "long1": self.start.long, "alt1": self.start.alt,
                 "lat2": self.end.lat, "long2": self.end.long, "alt2": self.end.alt}
     
-    def great_circle(self) -> float:
-        lat1 = math.radians(self.start.lat)
-        long1 = math.radians(self.start.long)
-        lat2 = math.radians(self.end.lat)
-        long2 = math.radians(self.end.long)
-
-        if long1 > long2:
-            long_diff = long1 - long2
-        else:
-            long_diff = long2 - long1
-        
-        x = math.sin(lat1) * math.sin(lat2) + math.cos(lat1) * math.cos(lat2) * math.cos(long_diff)
-        if x > 1.0:
-            x = 1.0
-        elif x < -1.0:
-            x = -1.0
-        dist_radians = math.acos(x)
-        return MEAN_EARTH_RADIUS_METERS * dist_radians
-    
     def __str__(self) -> str:
-        return f"LOS: {self.start}\nAOS: {self.end}\nGreat Circle: {self.great_circle()}m"
+        return f"LOS: {self.start}\nAOS: {self.end}"
+
+
 
+def _intern(value: str | None) -> str | None:
+    '''Intern strings that repeat across snapshots so every update shares one copy'''
+    return sys.intern(value) if value is not None else None
 
 
 class Flight(object):
     '''Representation of a distinct flight of an aircraft e.g takeoff to landing'''
+    __slots__ = ('hex', 'last_position')
 
-    def __init__(self, update: dict, update_time: datetime.datetime) -> None:
-        self.last_position = None
+    def __init__(self, hex: str, update: dict, update_time: int) -> None:
+        self.hex = hex
+        self.last_position: Position | None = None
         self.process_update(update, update_time)
 
-    def process_update(self, update: dict, update_time: datetime.datetime) -> Dropout:
+    def process_update(self, update: dict, update_time: int) -> Dropout | None:
         if not update.get('lat') or not update.get('lon'):
-            return
+            return None
 
         last_last_pos = self.last_position
-        self.last_position = Position(update, update_time)
+        self.last_position = Position(update_time, update['lat'], update['lon'], update.get('alt_baro'), update['type'],
+                                      update.get('alt_geom'))
         if last_last_pos:
             update_delta = update_time - last_last_pos.time
-            if update_delta >= LAST_POS_DELTA:
-                dropout = Dropout(update['hex'], last_last_pos, self.last_position)
+            if update_delta >= LAST_POS_DELTA_NS:
+                dropout = Dropout(self.hex, last_last_pos, self.last_position)
                 return dropout
         return None
 
 
 class Aircraft(object):
     '''Representation of a unique airframe/hexcode'''
+    __slots__ = ('hex', 'registration', 'type', '_dbFlags', 'current_flight', 'flight')
 
-    def __init__(self, update: dict, update_time: datetime.datetime) -> None:
-        self.hex = update['hex']
-        self.registration = update.get('r', None)
-        self.type = update.get('t', None)
+    def __init__(self, hex: str, update: dict, update_time: int) -> None:
+        self.hex = hex
+        self.registration = _intern(update.get('r', None))
+        self.type = _intern(update.get('t', None))
         self._dbFlags = update.get('dbFlags', 0)
-        self.current_flight = update.get('flight', self.registration if self.registration else self.hex)
-        self.flight = Flight(update, update_time)
+        self.current_flight = _intern(update.get('flight', self.registration if self.registration else self.hex))
+        self.flight = Flight(hex, update, update_time)
 
-    def process_update(self, update: dict, update_time: datetime.datetime) -> Dropout:
-        if self.registration != update.get('r', self.registration):
-            self.registration = update.get('r', self.registration)
+    def process_update(self, update: dict, update_time: int) -> Dropout | None:
+        registration, type, flight = update.get('r'), update.get('t'), update.get('flight')
 
-        if self.type != update.get('t', self.type):
-            self.type = update.get('t', self.type)
+        # Each stored value is read once per update, so they are compared in place rather than copied into locals
+        if registration is not None and registration != self.registration:
+            self.registration = sys.intern(registration)
+        if type is not None and type != self.type:
+            self.type = sys.intern(type)
 
-        if self.current_flight != update.get('flight', self.current_flight):
-            self.current_flight = update.get('flight', self.current_flight)
-            self.flight = Flight(update, update_time)
+        if flight is not None and flight != self.current_flight:
+            self.current_flight = sys.intern(flight)
+            self.flight = Flight(self.hex, update, update_time)
             return None
 
         return self.flight.process_update(update, update_time)
@@ -153,51 +188,105 @@ class Aircraft(object):
 class World(object):
     '''Representation of the world'''
     def __init__(self) -> None:
-        self.aircraft = {}
-        self.dropouts = []
+        self.aircraft: dict[str, Aircraft] = {}
+        self.dropouts: list[Dropout] = []
+        self.distances: np.ndarray = np.empty(0)  # Great circle meters of each dropout, filled in by finalize()
     
-    def process_aircraft(self, aircraft_update: dict, update_time: datetime.datetime) -> None:
-        hex = aircraft_update['hex']
-        if aircraft_update.get('lastPosition') or aircraft_update.get('seen') >= LAST_POS_THRESHOLD:
-            return
-        
+    def process_aircraft(self, aircraft_update: dict, update_time: int) -> None:
+        '''Fold in an update, stale positions (lastPosition set or seen past LAST_POS_THRESHOLD) must already be filtered out'''
+        hex = sys.intern(aircraft_update['hex'])
         aircraft = self.aircraft.get(hex, None)
         if aircraft:
             dropout = aircraft.process_update(aircraft_update, update_time)
             if dropout:
                 self.dropouts.append(dropout)
         else:
-            self.aircraft[hex] = Aircraft(aircraft_update, update_time)
-
-
-def load_files(queue: Queue) -> None:
-    files = os.listdir(DATA_DIR)
-    files = sorted(files)
-    for file in tqdm(files):
-        data_time = datetime.datetime.strptime(file, '%H%M%SZ.json.gz').replace(year=2022, month=3, day=1)
-        logging.info(f"Loading data for time {data_time}")
-
-        with gzip.open(f'{DATA_DIR}/{file}', 'r') as json_file:
-            queue.put((json.load(json_file), data_time), block=True)
-    queue.put(None)
+            self.aircraft[hex] = Aircraft(hex, aircraft_update, update_time)
+
+    def finalize(self) -> None:
+        '''Compute the distance of every dropout in one batch, call again after further updates to refresh'''
+        lat1 = np.fromiter((d.start.lat for d in self.dropouts), dtype=np.float64, count=len(self.dropouts))
+        long1 = np.fromiter((d.start.long for d in self.dropouts), dtype=np.float64, count=len(self.dropouts))
+        lat2 = np.fromiter((d.end.lat for d in self.dropouts), dtype=np.float64, count=len(self.dropouts))
+        long2 = np.fromiter((d.end.long for d in self.dropouts), dtype=np.float64, count=len(self.dropouts))
+        self.distances = great_circle(lat1, long1, lat2, long2)
+
+
+def _project(aircraft: dict, fields: tuple = UPDATE_FIELDS) -> dict:
+    '''Slim a readsb aircraft record down to fields'''
+    update = {key: aircraft[key] for key in fields if key in aircraft}
+    if 'lastPosition' in aircraft:
+        update['lastPosition'] = True
+    return update
+
+def _read(file: str) -> tuple:
+    # Snapshots are named HHMMSSZ.json.gz
+    data_time = DATA_DATE_NS + (int(file[0:2]) * 3600 + int(file[2:4]) * 60 + int(file[4:6])) * 1_000_000_000
+    with igzip.open(f'{DATA_DIR}/{file}', 'rb') as json_file:
+        return data_time, orjson.loads(json_file.read())['aircraft']
+
+def load_snapshot(file: str) -> tuple:
+    '''Time in ns and projected aircraft records of a snapshot in DATA_DIR, stale records included'''
+    data_time, aircraft_list = _read(file)
+    return data_time, [_project(aircraft, SNAPSHOT_FIELDS) for aircraft in aircraft_list]
+
+def _load_fresh(file: str) -> tuple:
+    '''Like load_snapshot, but drops records without a recent position before they leave the worker'''
+    data_time, aircraft_list = _read(file)
+    return data_time, [_project(aircraft) for aircraft in aircraft_list
+                       if 'lastPosition' not in aircraft and aircraft['seen'] < LAST_POS_THRESHOLD]
+
+def _process_json(world: World) -> None:
+    files = sorted(os.listdir(DATA_DIR))
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for data_time, aircraft_list in tqdm(executor.map(_load_fresh, files, chunksize=8), total=len(files)):
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Loading data for time %s", np.datetime64(data_time, 'ns'))
+
+            # Drain the map at C level rather than stepping a Python for loop per aircraft
+            deque(map(partial(world.process_aircraft, update_time=data_time), aircraft_list), maxlen=0)
+
+def _snapshot_row_groups() -> list:
+    '''(path, row group id) of every snapshot in PARQUET_DIR in time order, convert.py writes one row group per snapshot'''
+    dataset = pyarrow.dataset.dataset(PARQUET_DIR, format='parquet', schema=PARQUET_SCHEMA)
+    # One file per hour, sorting by path keeps the row groups in time order
+    return [(fragment.path, row_group.id)
+            for fragment in sorted(dataset.get_fragments(), key=lambda fragment: fragment.path)
+            for row_group in fragment.row_groups]
+
+def _load_parquet_fresh(row_group: tuple) -> tuple:
+    '''Parquet counterpart of _load_fresh, reads one snapshot and shapes its fresh rows like projected readsb records'''
+    path, row_group_id = row_group
+    table = pq.ParquetFile(path).read_row_group(row_group_id)
+    data_time = table['t_ns'][0].as_py()
+    table = table.filter((pc.field('seen') < LAST_POS_THRESHOLD) & ~pc.field('lastPosition'))
+    # Whole columns convert to Python in C, the dictionary encoded type column is decoded to plain strings first
+    columns = [table[name].cast(pa.string()).to_pylist() if name == 'type' else table[name].to_pylist() for name in UPDATE_COLUMNS]
+    updates = []
+    for row, ground in zip(zip(*columns), table['ground'].to_pylist()):
+        # Absent fields are missing rather than None, as in a readsb record
+        update = {name: value for name, value in zip(UPDATE_COLUMNS, row) if value is not None}
+        if ground:
+            update['alt_baro'] = 'ground'
+        updates.append(update)
+    return data_time, updates
+
+def _process_parquet(world: World) -> None:
+    row_groups = _snapshot_row_groups()
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for data_time, aircraft_list in tqdm(executor.map(_load_parquet_fresh, row_groups, chunksize=8), total=len(row_groups)):
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Loading data for time %s", np.datetime64(data_time, 'ns'))
+
+            deque(map(partial(world.process_aircraft, update_time=data_time), aircraft_list), maxlen=0)
 
 def main() -> World:
     world = World()
-    queue = Queue(MAX_QUEUE_SIZE)
-    p = Process(target=load_files, args=(queue,))
-    p.start()
-
-    while True:
-        data = queue.get(block=True)
-        if not data:
-            break
-        data_time = data[1]
-        logging.info(f"Loading data for time {data_time}")
-        
-        for aircraft in data[0]['aircraft']:
-            world.process_aircraft(aircraft, data_time)
-    p.join()
-    
+    if os.path.isdir(PARQUET_DIR):
+        _process_parquet(world)
+    else:
+        _process_json(world)
+    world.finalize()
     return world
 
 if __name__ == "__main__":